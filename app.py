@@ -1,7 +1,7 @@
 import torch
 import torch.nn as nn
-import torchvision.transforms as T
-import torchvision.transforms.v2 as T_v2
+import kornia.augmentation as K
+import numpy as np
 from torch.utils.data import DataLoader, Dataset
 from torchvision.models import resnet18, ResNet18_Weights
 from lightly.loss import NegativeCosineSimilarity
@@ -11,13 +11,18 @@ import os
 from PIL import Image
 import io
 from azure.storage.blob import BlobServiceClient
+from azure.storage.blob.aio import BlobServiceClient as AsyncBlobServiceClient
+import asyncio
+import concurrent.futures
 import multiprocessing
 import copy
-import glob
+import json
+import tarfile
 from sklearn.model_selection import train_test_split
 from torch.optim.lr_scheduler import CosineAnnealingLR
 import math
 import shutil # Import shutil for copying files
+import zstandard
 
 # DDP imports
 import torch.distributed as dist
@@ -27,28 +32,40 @@ from torch.utils.data.distributed import DistributedSampler
 # Allow loading of large images that might otherwise raise an error
 Image.MAX_IMAGE_PIXELS = None
 
-# --- Worker function for parallel preprocessing (No changes) ---
+# Packed patch cache: one contiguous [N, PATCH_SIZE, PATCH_SIZE, 3] uint8 file plus its metadata
+PATCH_SHARD_FILENAME = 'patches.bin'
+PATCH_SHARD_META_FILENAME = 'patches_meta.json'
+
+# Checkpoints are zstd-compressed; the frame magic lets the loader still read older uncompressed files
+ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'
+
+# --- Worker function for parallel preprocessing (one WebDataset-style tar shard per source image) ---
 def process_blob(args):
-    blob_name, connection_string, source_container, local_target_dir, patch_size = args
-    blob_service_client = BlobServiceClient.from_connection_string(connection_string)
-    container_client = blob_service_client.get_container_client(source_container)
+    blob_name, image_bytes, local_target_dir, patch_size = args
+    original_filename = os.path.splitext(blob_name)[0].replace("/", "_")
+    tar_path = os.path.join(local_target_dir, f"{original_filename}.tar")
     try:
-        downloader = container_client.get_blob_client(blob_name).download_blob()
-        image_bytes = downloader.readall()
         with Image.open(io.BytesIO(image_bytes)) as img:
-            width, height = img.size
-            patch_num = 0
-            for y in range(0, height - patch_size + 1, patch_size):
-                for x in range(0, width - patch_size + 1, patch_size):
-                    box = (x, y, x + patch_size, y + patch_size)
-                    patch = img.crop(box).convert('RGB')
-                    original_filename = os.path.splitext(blob_name)[0].replace("/", "_")
-                    patch_filename = f"{original_filename}_patch_{patch_num}.png"
-                    save_path = os.path.join(local_target_dir, patch_filename)
-                    patch.save(save_path)
-                    patch_num += 1
-        return f"Processed {blob_name}"
+            image_array = np.asarray(img.convert('RGB'))
+        # Zero-copy (rows, cols, patch_size, patch_size, 3) view of all full patches, in row-major order
+        rows, cols = image_array.shape[0] // patch_size, image_array.shape[1] // patch_size
+        patches = image_array[:rows * patch_size, :cols * patch_size].reshape(rows, patch_size, cols, patch_size, 3).swapaxes(1, 2)
+
+        # Written under a temporary name so an interrupted run never leaves a truncated shard behind
+        with tarfile.open(tar_path + '.tmp', 'w') as tar:
+            for patch_num, (row, col) in enumerate(np.ndindex(rows, cols)):
+                # Raw uint8 pixels (.npy): lossless, and the packing step copies them without decoding
+                patch_buffer = io.BytesIO()
+                np.save(patch_buffer, patches[row, col])
+                member = tarfile.TarInfo(f"{original_filename}_patch_{patch_num}.npy")
+                member.size = patch_buffer.tell()
+                patch_buffer.seek(0)
+                tar.addfile(member, patch_buffer)
+        os.replace(tar_path + '.tmp', tar_path)
+        return None
     except Exception as e:
+        if os.path.exists(tar_path + '.tmp'):
+            os.remove(tar_path + '.tmp')
         return f"Failed to process {blob_name}: {e}"
 
 # --- Checkpoint upload function (Modified for rank 0 only and epoch-based naming) ---
@@ -71,59 +88,216 @@ def upload_checkpoint_to_azure(connection_string, container_name, local_file_pat
     except Exception as e:
         print(f"WARNING: Failed to upload '{blob_name}' to Azure. Error: {e}")
 
+# --- Checkpoint serialization helpers ---
+def state_to_cpu(state):
+    """Detached CPU copy of a (nested) state dict, so training can keep mutating the GPU originals."""
+    if isinstance(state, torch.Tensor):
+        return state.detach().to('cpu', copy=True)
+    if isinstance(state, dict):
+        return {key: state_to_cpu(value) for key, value in state.items()}
+    if isinstance(state, (list, tuple)):
+        return type(state)(state_to_cpu(value) for value in state)
+    return state
+
+def tensor_bits(tensor):
+    """Integer view of a float tensor's bit pattern (non-float tensors are returned unchanged)."""
+    if not tensor.is_floating_point():
+        return tensor
+    return tensor.view({2: torch.int16, 4: torch.int32, 8: torch.int64}[tensor.element_size()])
+
+def target_delta_state_dict(target_state_dict, online_state_dict):
+    """
+    EMA target stored as the XOR of its bit patterns with the online network's. This is exactly
+    invertible, and the sign/exponent/high mantissa bits the two share become zeros that compress well.
+    """
+    return {key: tensor_bits(value) ^ tensor_bits(online_state_dict[key]) if value.is_floating_point() else value
+            for key, value in target_state_dict.items()}
+
+def checkpoint_target_state_dict(checkpoint):
+    if 'target_network_delta_state_dict' not in checkpoint:
+        return checkpoint['target_network_state_dict']  # Checkpoints written before delta encoding
+    online_state_dict = checkpoint['online_network_state_dict']
+    return {key: (value ^ tensor_bits(online_state_dict[key])).view(online_state_dict[key].dtype)
+            if online_state_dict[key].is_floating_point() else value
+            for key, value in checkpoint['target_network_delta_state_dict'].items()}
+
+def save_checkpoint_file(checkpoint, local_file_path):
+    buffer = io.BytesIO()
+    torch.save(checkpoint, buffer)
+    with open(local_file_path, "wb") as f:
+        f.write(zstandard.ZstdCompressor(level=3, threads=-1).compress(buffer.getvalue()))
+
+def load_checkpoint_bytes(data, map_location):
+    if data[:4] == ZSTD_MAGIC:
+        data = zstandard.ZstdDecompressor().decompress(data)
+    return torch.load(io.BytesIO(data), map_location=map_location)
+
+# --- Background checkpoint writer: compress, save and upload off the training critical path ---
+def save_and_upload_checkpoint(checkpoint, target_state_dict, connection_string, container_name, local_dir, epoch, rank):
+    current_epoch_checkpoint_filename = f"model_checkpoint_epoch_{epoch+1:03d}.pth"
+    current_epoch_checkpoint_path = os.path.join(local_dir, current_epoch_checkpoint_filename)
+    checkpoint['target_network_delta_state_dict'] = target_delta_state_dict(target_state_dict, checkpoint['online_network_state_dict'])
+    save_checkpoint_file(checkpoint, current_epoch_checkpoint_path)
+    print(f"✅ Checkpoint for epoch {epoch+1} saved locally: {current_epoch_checkpoint_path}")
+
+    upload_checkpoint_to_azure(
+        connection_string,
+        container_name,
+        current_epoch_checkpoint_path,
+        current_epoch_checkpoint_filename,
+        rank
+    )
+
+    latest_resume_blob_name = "latest_resume_checkpoint.pth"
+    latest_resume_checkpoint_path = os.path.join(local_dir, latest_resume_blob_name)
+    shutil.copyfile(current_epoch_checkpoint_path, latest_resume_checkpoint_path)
+    upload_checkpoint_to_azure(
+        connection_string,
+        container_name,
+        latest_resume_checkpoint_path,
+        latest_resume_blob_name,
+        rank
+    )
+    print(f"✅ 'latest_resume_checkpoint.pth' updated in Azure.")
+
+# --- Async download orchestrator: one shared client, bounded concurrent downloads, patching in a process pool ---
+async def download_and_process_blobs(connection_string, source_container, local_target_dir, patch_size, max_concurrent_downloads=64):
+    """
+    Downloads and patches every image blob. Returns the number of images found and the
+    error messages of the ones that failed.
+    """
+    loop = asyncio.get_running_loop()
+    max_workers = os.cpu_count()
+    download_semaphore = asyncio.Semaphore(max_concurrent_downloads)
+    # Separate backlog limit sized to the pool: keeps every worker busy whatever the download limit is, and a
+    # finished download keeps its slot until it gets one, so at most downloads + backlog images sit in memory
+    processing_semaphore = asyncio.Semaphore(max_workers * 2)
+    async with AsyncBlobServiceClient.from_connection_string(connection_string) as blob_service_client:
+        container_client = blob_service_client.get_container_client(source_container)
+        image_blobs = [blob.name async for blob in container_client.list_blobs() if blob.name.lower().endswith(('jpg', 'jpeg', 'png'))]
+        if not image_blobs:
+            return 0, []
+
+        failures = []
+        with concurrent.futures.ProcessPoolExecutor(max_workers=max_workers) as executor:
+            async def download_and_process(blob_name):
+                async with download_semaphore:
+                    try:
+                        downloader = await container_client.get_blob_client(blob_name).download_blob()
+                        image_bytes = await downloader.readall()
+                    except Exception as e:
+                        return f"Failed to download {blob_name}: {e}"
+                    await processing_semaphore.acquire()
+                try:
+                    return await loop.run_in_executor(executor, process_blob, (blob_name, image_bytes, local_target_dir, patch_size))
+                finally:
+                    processing_semaphore.release()
+
+            with tqdm(total=len(image_blobs), desc="Processing Images in Parallel") as progress:
+                for result in asyncio.as_completed([download_and_process(blob_name) for blob_name in image_blobs]):
+                    error = await result
+                    if error is not None:
+                        failures.append(error)
+                    progress.update(1)
+    return len(image_blobs), failures
+
 # --- Preprocessing orchestrator (Modified for rank 0 only) ---
 def preprocess_and_save_locally(connection_string, source_container, local_target_dir, patch_size=224, rank=0):
     if rank != 0:  # Only rank 0 does preprocessing
         return
-    if os.path.exists(local_target_dir) and len(os.listdir(local_target_dir)) > 0:
-        print(f"Patches already exist in local cache ('{local_target_dir}'). Skipping preprocessing.")
+    if os.path.exists(os.path.join(local_target_dir, PATCH_SHARD_META_FILENAME)):
+        print(f"Patch shard already exists in local cache ('{local_target_dir}'). Skipping preprocessing.")
+        return
+    if os.path.isdir(local_target_dir) and any(entry.name.endswith('.tar') for entry in os.scandir(local_target_dir)):
+        print(f"Patches already exist in local cache ('{local_target_dir}'). Skipping download.")
+        pack_patches_into_shard(local_target_dir, patch_size)
         return
     print(f"Starting parallel preprocessing: downloading from '{source_container}'...")
     os.makedirs(local_target_dir, exist_ok=True)
     try:
-        blob_service_client = BlobServiceClient.from_connection_string(connection_string)
-        container_client = blob_service_client.get_container_client(source_container)
-        image_blobs = [blob.name for blob in container_client.list_blobs() if blob.name.lower().endswith(('jpg', 'jpeg', 'png'))]
-        if not image_blobs:
+        num_images, failures = asyncio.run(download_and_process_blobs(connection_string, source_container, local_target_dir, patch_size))
+        if num_images == 0:
             print(f"Warning: No images found in source container '{source_container}'.")
             return
-        tasks = [(blob_name, connection_string, source_container, local_target_dir, patch_size) for blob_name in image_blobs]
-        with multiprocessing.Pool(processes=os.cpu_count()) as pool:
-            for _ in tqdm(pool.imap_unordered(process_blob, tasks), total=len(tasks), desc="Processing Images in Parallel"):
-                pass
-        print(f"✅ Parallel preprocessing complete. All patches saved to '{local_target_dir}'.")
+        if failures:
+            # Reported before packing, since the shard metadata marks the cache as complete
+            print(f"WARNING: {len(failures)} of {num_images} images failed and will be missing from the patch shard:")
+            for error in failures:
+                print(f"  {error}")
+        print(f"✅ Parallel preprocessing complete. Patches from {num_images - len(failures)} images saved to '{local_target_dir}'.")
     except Exception as e:
         print(f"FATAL: An error occurred during preprocessing orchestration: {e}")
         raise
-
-# --- Dataset Class (No changes) ---
+    pack_patches_into_shard(local_target_dir, patch_size)
+
+# --- Helper: number of patches stored in a tar shard (reads headers only) ---
+def count_tar_patches(tar_path):
+    with tarfile.open(tar_path) as tar:
+        return sum(1 for member in tar if member.isfile())
+
+# --- Worker function for streaming one tar shard's patches into the memory-mapped shard ---
+def pack_patch_tar(args):
+    tar_path, shard_path, shard_shape, start_index = args
+    shard = np.memmap(shard_path, dtype=np.uint8, mode='r+', shape=shard_shape)
+    packed = 0
+    with tarfile.open(tar_path) as tar:
+        for member in tar:
+            if not member.isfile():
+                continue
+            # np.load can't take the tar member stream directly (it probes fileno()), so read it into memory first
+            shard[start_index + packed] = np.load(io.BytesIO(tar.extractfile(member).read()))
+            packed += 1
+    shard.flush()
+    return packed
+
+# --- Pack the tar shards into one memory-mapped uint8 shard ---
+def pack_patches_into_shard(local_target_dir, patch_size):
+    tar_paths = sorted(entry.path for entry in os.scandir(local_target_dir) if entry.name.endswith('.tar'))
+    if not tar_paths:
+        print(f"Warning: No patch shards found in '{local_target_dir}' to pack.")
+        return
+    with multiprocessing.Pool(processes=os.cpu_count()) as pool:
+        patch_counts = np.array(pool.map(count_tar_patches, tar_paths), dtype=np.int64)
+    num_patches = int(patch_counts.sum())
+    if num_patches == 0:
+        print(f"Warning: No patches found in '{local_target_dir}' to pack.")
+        return
+    shard_path = os.path.join(local_target_dir, PATCH_SHARD_FILENAME)
+    shard_shape = (num_patches, patch_size, patch_size, 3)
+    np.memmap(shard_path, dtype=np.uint8, mode='w+', shape=shard_shape).flush()  # Allocate the file once
+
+    # Each tar is read sequentially by one worker and written to its own contiguous slice of the shard
+    start_indices = np.concatenate(([0], np.cumsum(patch_counts)[:-1]))
+    tasks = [(tar_path, shard_path, shard_shape, int(start)) for tar_path, start in zip(tar_paths, start_indices)]
+    with multiprocessing.Pool(processes=os.cpu_count()) as pool:
+        with tqdm(total=num_patches, desc="Packing Patches into Shard") as progress:
+            for packed in pool.imap_unordered(pack_patch_tar, tasks):
+                progress.update(packed)
+
+    # Metadata is written last so its presence marks a complete shard
+    with open(os.path.join(local_target_dir, PATCH_SHARD_META_FILENAME), 'w') as f:
+        json.dump({'num_patches': num_patches, 'patch_size': patch_size}, f)
+    # Nothing reads the tar shards once the packed shard is complete, so don't keep a second raw copy on disk
+    for tar_path in tar_paths:
+        os.remove(tar_path)
+    print(f"✅ Packed {num_patches} patches into '{shard_path}'.")
+
+# --- Dataset Class (slices decoded uint8 patches out of the memory-mapped shard) ---
 class PatchedImageDataset(Dataset):
-    def __init__(self, image_paths, transform=None, mode='train'):
-        self.image_paths = image_paths
-        self.transform = transform
-        self.mode = mode
+    def __init__(self, shard_path, shard_shape, indices):
+        self.shard_path = shard_path
+        self.shard_shape = shard_shape
+        self.indices = indices
+        self.shard = None
 
     def __len__(self):
-        return len(self.image_paths)
+        return len(self.indices)
 
     def __getitem__(self, idx):
-        image_path = self.image_paths[idx]
-        patch = Image.open(image_path).convert('RGB')
-        if self.transform:
-            if self.mode == 'train':
-                view1, view2 = self.transform(patch)
-                return (view1, view2), 0
-            else:
-                view = self.transform(patch)
-                return view, 0
-        return patch, 0
-
-# --- GLOBAL SCOPE: BYOLTransformWrapper moved here to be picklable ---
-class BYOLTransformWrapper:
-    def __init__(self, transform):
-        self.transform = transform
-    def __call__(self, image):
-        return self.transform(image), self.transform(image)
+        if self.shard is None:  # Mapped lazily so each DataLoader worker opens its own view of the file
+            self.shard = np.memmap(self.shard_path, dtype=np.uint8, mode='r', shape=self.shard_shape)
+        patch = torch.from_numpy(np.array(self.shard[self.indices[idx]]))
+        return patch.permute(2, 0, 1), 0
 
 # --- Helper function for EMA Cosine Scheduling ---
 def get_ema_decay(epoch, total_epochs, start_decay=0.99, end_decay=1.0):
@@ -134,11 +308,24 @@ def get_ema_decay(epoch, total_epochs, start_decay=0.99, end_decay=1.0):
     cosine_schedule = 0.5 * (1 + math.cos(math.pi * epoch / total_epochs))
     return end_decay - (end_decay - start_decay) * cosine_schedule
 
-# --- Manual EMA update function (No changes) ---
+# --- Manual EMA update function (fused multi-tensor lerp) ---
 def update_moving_average(ema_model, model, decay):
-    with torch.no_grad():
-        for target_param, online_param in zip(ema_model.parameters(), model.parameters()):
-            target_param.data = decay * target_param.data + (1 - decay) * online_param.data
+    # lerp(t, o, 1 - decay) == decay * t + (1 - decay) * o, issued as one multi-tensor kernel
+    with torch.inference_mode():
+        target_params = [p.data for p in ema_model.parameters()]
+        online_params = [p.data for p in model.parameters()]
+        torch._foreach_lerp_(target_params, online_params, 1.0 - decay)
+
+        # BN running stats follow the same EMA; integer buffers (num_batches_tracked) are copied
+        target_buffers, online_buffers = [], []
+        for target_buffer, online_buffer in zip(ema_model.buffers(), model.buffers()):
+            if target_buffer.is_floating_point():
+                target_buffers.append(target_buffer)
+                online_buffers.append(online_buffer)
+            else:
+                target_buffer.copy_(online_buffer)
+        if target_buffers:
+            torch._foreach_lerp_(target_buffers, online_buffers, 1.0 - decay)
 
 # --- DDP Setup Functions ---
 def setup(rank, world_size):
@@ -157,6 +344,12 @@ def main_worker(rank, world_size):
     print(f"Rank {rank} using GPU {rank}")
     setup(rank, world_size)
 
+    # Every training batch has the same shape (drop_last=True), so let cuDNN autotune conv algorithms once;
+    # TF32 puts any remaining FP32 matmuls/convs on tensor cores
+    torch.backends.cudnn.benchmark = True
+    torch.backends.cuda.matmul.allow_tf32 = True
+    torch.backends.cudnn.allow_tf32 = True
+
     # --- Configuration ---
     SOURCE_DATA_CONTAINER = "data"
     LOCAL_PATCH_CACHE_DIR = 'data_patches'  # Changed to separate directory for patches
@@ -166,7 +359,7 @@ def main_worker(rank, world_size):
     NUM_EPOCHS = 100
     DEVICE = f'cuda:{rank}'  # Each process uses its own GPU (0, 1, 2, or 3)
     torch.cuda.set_device(rank)
-    DATALOADER_WORKERS = 4
+    DATALOADER_WORKERS = max(1, os.cpu_count() // world_size)  # Workers only decode now; split the CPUs across ranks
     LR = 1e-3 * world_size  # Scale learning rate with number of GPUs (4e-3 for 4 GPUs)
     VAL_SPLIT = 0.1
     TEST_SPLIT = 0.1
@@ -202,55 +395,61 @@ def main_worker(rank, world_size):
     dist.barrier()
 
     # --- Data Splitting (All ranks need same split) ---
-    all_patches = glob.glob(os.path.join(LOCAL_PATCH_CACHE_DIR, '*.png'))
-    if not all_patches:
+    shard_meta_path = os.path.join(LOCAL_PATCH_CACHE_DIR, PATCH_SHARD_META_FILENAME)
+    if not os.path.exists(shard_meta_path):
         if rank == 0:
-            print(f"Error: No patches found in '{LOCAL_PATCH_CACHE_DIR}'. Aborting.")
+            print(f"Error: No patch shard found in '{LOCAL_PATCH_CACHE_DIR}'. Aborting.")
         cleanup()
         return
+    with open(shard_meta_path) as f:
+        shard_meta = json.load(f)
+    shard_path = os.path.join(LOCAL_PATCH_CACHE_DIR, PATCH_SHARD_FILENAME)
+    shard_shape = (shard_meta['num_patches'], shard_meta['patch_size'], shard_meta['patch_size'], 3)
 
     # Use same random seed across all ranks for consistent splits
-    train_paths, temp_paths = train_test_split(all_patches, test_size=(VAL_SPLIT + TEST_SPLIT), random_state=42)
-    val_paths, test_paths = train_test_split(temp_paths, test_size=(TEST_SPLIT / (VAL_SPLIT + TEST_SPLIT)), random_state=42)
+    all_indices = np.arange(shard_meta['num_patches'])
+    train_indices, temp_indices = train_test_split(all_indices, test_size=(VAL_SPLIT + TEST_SPLIT), random_state=42)
+    val_indices, test_indices = train_test_split(temp_indices, test_size=(TEST_SPLIT / (VAL_SPLIT + TEST_SPLIT)), random_state=42)
 
     if rank == 0:
         print("-" * 50)
-        print(f"Training set size: {len(train_paths)}, Validation set size: {len(val_paths)}, Test set size: {len(test_paths)}")
+        print(f"Training set size: {len(train_indices)}, Validation set size: {len(val_indices)}, Test set size: {len(test_indices)}")
         print("-" * 50)
 
     # --- Data Transforms ---
-    v2_transforms = T_v2.Compose([T_v2.ToImage(), T_v2.ToDtype(torch.float32, scale=True)])
-    train_transform = T.Compose([
-        T.RandomResizedCrop(size=PATCH_SIZE),
-        T.RandomHorizontalFlip(p=0.5),
-        T.RandomApply([T.ColorJitter(0.8, 0.8, 0.8, 0.2)], p=0.8),
-        T.RandomGrayscale(p=0.2),
-        T.RandomApply([T.GaussianBlur(23)], p=0.5),
-        T.RandomSolarize(192.0, p=0.2),
-        v2_transforms,
-        T.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225])
-    ])
-    val_test_transform = T.Compose([
-        T.Resize((PATCH_SIZE, PATCH_SIZE)), v2_transforms,
-        T.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225])
-    ])
+    # Workers only slice uint8 patches out of the shard; the BYOL augmentations run batched on the GPU
+    # (Kornia samples independent parameters per batch element, so each view stays distinct).
+    # Patches are already PATCH_SIZE, so val/test only need normalization.
+    gpu_normalize = K.Normalize(mean=torch.tensor([0.485, 0.456, 0.406]), std=torch.tensor([0.229, 0.224, 0.225])).to(DEVICE)
+    gpu_augment = nn.Sequential(
+        K.RandomResizedCrop(size=(PATCH_SIZE, PATCH_SIZE)),
+        K.RandomHorizontalFlip(p=0.5),
+        K.ColorJitter(0.8, 0.8, 0.8, 0.2, p=0.8),
+        K.RandomGrayscale(p=0.2),
+        K.RandomGaussianBlur((23, 23), sigma=(0.1, 2.0), p=0.5),
+        K.RandomSolarize(thresholds=(192 / 255, 192 / 255), additions=0.0, p=0.2),
+        gpu_normalize
+    ).to(DEVICE)
 
     # --- Datasets and DataLoaders with DistributedSampler ---
-    train_dataset = PatchedImageDataset(train_paths, transform=BYOLTransformWrapper(train_transform), mode='train')
-    val_dataset = PatchedImageDataset(val_paths, transform=val_test_transform, mode='val')
-    test_dataset = PatchedImageDataset(test_paths, transform=val_test_transform, mode='test')
+    train_dataset = PatchedImageDataset(shard_path, shard_shape, train_indices)
+    val_dataset = PatchedImageDataset(shard_path, shard_shape, val_indices)
+    test_dataset = PatchedImageDataset(shard_path, shard_shape, test_indices)
 
     # Create distributed samplers
     train_sampler = DistributedSampler(train_dataset, num_replicas=world_size, rank=rank, shuffle=True)
     val_sampler = DistributedSampler(val_dataset, num_replicas=world_size, rank=rank, shuffle=False)
     test_sampler = DistributedSampler(test_dataset, num_replicas=world_size, rank=rank, shuffle=False)
 
+    # Persistent workers avoid respawning every epoch; pinned memory allows async (non_blocking) H2D copies
     train_loader = DataLoader(train_dataset, batch_size=BATCH_SIZE, sampler=train_sampler,
-                             num_workers=DATALOADER_WORKERS, drop_last=True, pin_memory=True)
+                             num_workers=DATALOADER_WORKERS, drop_last=True, pin_memory=True,
+                             persistent_workers=True, prefetch_factor=4)
     val_loader = DataLoader(val_dataset, batch_size=BATCH_SIZE, sampler=val_sampler,
-                            num_workers=DATALOADER_WORKERS, drop_last=False)
+                            num_workers=DATALOADER_WORKERS, drop_last=False, pin_memory=True,
+                            persistent_workers=True, prefetch_factor=4)
     test_loader = DataLoader(test_dataset, batch_size=BATCH_SIZE, sampler=test_sampler,
-                             num_workers=DATALOADER_WORKERS, drop_last=False)
+                             num_workers=DATALOADER_WORKERS, drop_last=False, pin_memory=True)
 
     # --- Model Initialization ---
     if rank == 0:
@@ -258,8 +457,13 @@ def main_worker(rank, world_size):
 
     backbone = resnet18(weights=ResNet18_Weights.IMAGENET1K_V1)
     backbone.fc = nn.Identity()
-    online_network = nn.Sequential(backbone, BYOLProjectionHead(512, 4096, 256)).to(DEVICE)
-    target_network = copy.deepcopy(online_network).to(DEVICE)
+    # channels_last (NHWC) lets cuDNN pick its faster NHWC tensor-core conv kernels
+    online_network = nn.Sequential(backbone, BYOLProjectionHead(512, 4096, 256)).to(DEVICE, memory_format=torch.channels_last)
+    target_network = copy.deepcopy(online_network).to(DEVICE, memory_format=torch.channels_last)
+    # The target is only ever updated by EMA (weights and BN stats), so it never needs grads or batch-stat BN
+    for param in target_network.parameters():
+        param.requires_grad_(False)
+    target_network.eval()
     prediction_head = BYOLPredictionHead(256, 4096, 256).to(DEVICE)
 
     # Wrap models with DDP
@@ -267,7 +471,8 @@ def main_worker(rank, world_size):
     prediction_head = DDP(prediction_head, device_ids=[rank])
     # Note: target_network is not wrapped in DDP as it's updated via EMA
 
-    optimizer = torch.optim.Adam(list(online_network.parameters()) + list(prediction_head.parameters()), lr=LR)
+    # Fused Adam runs the whole update in one CUDA kernel (torch >= 2.0 is already required by torch.compile)
+    optimizer = torch.optim.Adam(list(online_network.parameters()) + list(prediction_head.parameters()), lr=LR, fused=True)
     loss_fn = NegativeCosineSimilarity()
     scheduler = CosineAnnealingLR(optimizer, T_max=NUM_EPOCHS, eta_min=0)
 
@@ -303,11 +508,10 @@ def main_worker(rank, world_size):
                 print(f"Found latest checkpoint: '{latest_blob_name}'. Downloading...")
             blob_client = container_client.get_blob_client(latest_blob_name)
             downloader = blob_client.download_blob()
-            buffer = io.BytesIO(downloader.readall())
-            checkpoint = torch.load(buffer, map_location=DEVICE)
+            checkpoint = load_checkpoint_bytes(downloader.readall(), map_location=DEVICE)
 
             online_network.module.load_state_dict(checkpoint['online_network_state_dict'])
-            target_network.load_state_dict(checkpoint['target_network_state_dict'])
+            target_network.load_state_dict(checkpoint_target_state_dict(checkpoint))
             prediction_head.module.load_state_dict(checkpoint['prediction_head_state_dict'])
             optimizer.load_state_dict(checkpoint['optimizer_state_dict'])
             if 'scheduler_state_dict' in checkpoint:
@@ -324,11 +528,23 @@ def main_worker(rank, world_size):
         if rank == 0:
             print(f"INFO: An error occurred while trying to load latest checkpoint. Starting from scratch. Error: {e}")
 
+    # --- Kernel fusion with torch.compile ---
+    # Compiled after checkpoint loading and kept as separate handles: they share parameters with the
+    # eager modules, so state_dict save/load keeps using the un-prefixed (no `_orig_mod.`) keys.
+    compiled_online_network = torch.compile(online_network, mode='max-autotune')
+    compiled_target_network = torch.compile(target_network, mode='max-autotune')
+    compiled_prediction_head = torch.compile(prediction_head, mode='max-autotune')
 
     # --- Training & Validation Loop ---
     if rank == 0:
         print(f"Starting training for {NUM_EPOCHS} epochs...")
 
+    # Side stream for the target-network EMA update so it overlaps with the next batch's H2D copy and augmentation
+    ema_stream = torch.cuda.Stream(device=DEVICE)
+    # At most one background save/upload in flight (rank 0 only); .result() re-raises any failure in it
+    checkpoint_executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+    checkpoint_future = None
+
     for epoch in range(start_epoch, NUM_EPOCHS):
         train_sampler.set_epoch(epoch)
         current_ema_decay = get_ema_decay(epoch, NUM_EPOCHS, START_EMA_DECAY, END_EMA_DECAY)
@@ -342,23 +558,37 @@ def main_worker(rank, world_size):
         if rank == 0:
             train_iter = tqdm(train_loader, desc=f"Epoch {epoch+1}/{NUM_EPOCHS} [Train]")
 
-        for (view1, view2), _ in train_iter:
-            view1, view2 = view1.to(DEVICE), view2.to(DEVICE)
-            optimizer.zero_grad()
-
-            z0_online, z1_online = online_network(view1), online_network(view2)
-            with torch.no_grad():
-                z0_target, z1_target = target_network(view1), target_network(view2)
-            p0, p1 = prediction_head(z0_online), prediction_head(z1_online)
-
-            loss = 0.5 * (loss_fn(p0, z1_target.detach()) + loss_fn(p1, z0_target.detach()))
+        for view, _ in train_iter:
+            view = view.to(DEVICE, non_blocking=True).float().div_(255)
+            # Both views go through each network as one 2*BATCH_SIZE batch, then get split back apart
+            views = torch.cat([gpu_augment(view), gpu_augment(view)], dim=0).contiguous(memory_format=torch.channels_last)
+            optimizer.zero_grad(set_to_none=True)
+
+            # The previous EMA update reads the online BN running stats (mutated by the online forward) and
+            # writes the target weights (read by the target forward), so it must finish before either runs.
+            torch.cuda.current_stream().wait_stream(ema_stream)
+
+            # BF16 autocast: convs/matmuls run on tensor cores, no GradScaler needed (FP32 exponent range)
+            with torch.amp.autocast('cuda', dtype=torch.bfloat16):
+                z_online = compiled_online_network(views)
+                with torch.inference_mode():
+                    z_target = compiled_target_network(views)
+                # Inference tensors can't be saved for backward, and the loss saves the targets for the p gradients
+                z0_target, z1_target = z_target.clone().chunk(2, dim=0)
+                p0, p1 = compiled_prediction_head(z_online).chunk(2, dim=0)
+
+                loss = 0.5 * (loss_fn(p0, z1_target.detach()) + loss_fn(p1, z0_target.detach()))
             total_train_loss += loss.item()
 
             loss.backward()
             optimizer.step()
-            
+
             # Update target network after optimizer step to avoid in-place operation issues
-            update_moving_average(target_network, online_network.module, decay=current_ema_decay)
+            ema_stream.wait_stream(torch.cuda.current_stream())
+            with torch.cuda.stream(ema_stream):
+                update_moving_average(target_network, online_network.module, decay=current_ema_decay)
+
+        torch.cuda.current_stream().wait_stream(ema_stream)  # Target network is read by validation and checkpointing
 
         avg_train_loss = total_train_loss / len(train_loader)
         train_loss_tensor = torch.tensor(avg_train_loss).to(DEVICE)
@@ -376,7 +606,7 @@ def main_worker(rank, world_size):
 
         with torch.no_grad():
             for view1, _ in val_iter:
-                view1 = view1.to(DEVICE)
+                view1 = gpu_normalize(view1.to(DEVICE, non_blocking=True).float().div_(255)).contiguous(memory_format=torch.channels_last)
                 view2 = view1.clone()
                 z0_online, z1_online = online_network(view1), online_network(view2)
                 z0_target, z1_target = target_network(view1), target_network(view2)
@@ -395,43 +625,30 @@ def main_worker(rank, world_size):
             print(f"Epoch {epoch+1}/{NUM_EPOCHS} -> Train Loss: {avg_train_loss:.4f}, Val Loss: {avg_val_loss:.4f}")
             print(f"Current LR: {scheduler.get_last_lr()[0]:.6f}, Current EMA Decay: {current_ema_decay:.6f}")
 
-            # --- Checkpoint Saving for EVERY EPOCH (rank 0 only) ---
-            current_epoch_checkpoint_filename = f"model_checkpoint_epoch_{epoch+1:03d}.pth"
-            current_epoch_checkpoint_path = os.path.join(LOCAL_MODEL_OUTPUT_DIR, current_epoch_checkpoint_filename)
-
-            torch.save({
+            # --- Checkpoint Saving for EVERY EPOCH (rank 0 only, in a background thread) ---
+            if checkpoint_future is not None:
+                checkpoint_future.result()
+            checkpoint = {
                 'epoch': epoch,
-                'online_network_state_dict': online_network.module.state_dict(),
-                'target_network_state_dict': target_network.state_dict(),
-                'prediction_head_state_dict': prediction_head.module.state_dict(),
-                'optimizer_state_dict': optimizer.state_dict(),
+                'online_network_state_dict': state_to_cpu(online_network.module.state_dict()),
+                'prediction_head_state_dict': state_to_cpu(prediction_head.module.state_dict()),
+                'optimizer_state_dict': state_to_cpu(optimizer.state_dict()),
                 'scheduler_state_dict': scheduler.state_dict(),
                 'train_loss': avg_train_loss,
                 'val_loss': avg_val_loss,
                 'best_val_loss': min(best_val_loss, avg_val_loss)
-            }, current_epoch_checkpoint_path)
-            print(f"✅ Checkpoint for epoch {epoch+1} saved locally: {current_epoch_checkpoint_path}")
-
-            upload_checkpoint_to_azure(
-                connection_string,
-                CHECKPOINT_CONTAINER,
-                current_epoch_checkpoint_path,
-                current_epoch_checkpoint_filename,
-                rank
+            }
+            checkpoint_future = checkpoint_executor.submit(
+                save_and_upload_checkpoint,
+                checkpoint, state_to_cpu(target_network.state_dict()), connection_string,
+                CHECKPOINT_CONTAINER, LOCAL_MODEL_OUTPUT_DIR, epoch, rank
             )
 
-            latest_resume_blob_name = "latest_resume_checkpoint.pth"
-            latest_resume_checkpoint_path = os.path.join(LOCAL_MODEL_OUTPUT_DIR, latest_resume_blob_name)
-            shutil.copyfile(current_epoch_checkpoint_path, latest_resume_checkpoint_path)
-            upload_checkpoint_to_azure(
-                connection_string,
-                CHECKPOINT_CONTAINER,
-                latest_resume_checkpoint_path,
-                latest_resume_blob_name,
-                rank
-            )
-            if rank == 0:
-                print(f"✅ 'latest_resume_checkpoint.pth' updated in Azure.")
+    # The final test below reads the last checkpoint, so wait for rank 0 to finish writing it
+    if checkpoint_future is not None:
+        checkpoint_future.result()
+    checkpoint_executor.shutdown()
+    dist.barrier()
 
     # --- Final Test Phase ---
     if rank == 0:
@@ -453,9 +670,10 @@ def main_worker(rank, world_size):
             if rank == 0:
                 print("✅ Download complete.")
 
-        final_checkpoint = torch.load(final_model_path_local, map_location=DEVICE)
+        with open(final_model_path_local, "rb") as f:
+            final_checkpoint = load_checkpoint_bytes(f.read(), map_location=DEVICE)
         online_network.module.load_state_dict(final_checkpoint['online_network_state_dict'])
-        target_network.load_state_dict(final_checkpoint['target_network_state_dict'])
+        target_network.load_state_dict(checkpoint_target_state_dict(final_checkpoint))
         prediction_head.module.load_state_dict(final_checkpoint['prediction_head_state_dict'])
 
         if rank == 0:
@@ -471,7 +689,7 @@ def main_worker(rank, world_size):
 
         with torch.no_grad():
             for view1, _ in test_iter:
-                view1 = view1.to(DEVICE)
+                view1 = gpu_normalize(view1.to(DEVICE, non_blocking=True).float().div_(255)).contiguous(memory_format=torch.channels_last)
                 view2 = view1.clone()
                 z0_online, z1_online = online_network(view1), online_network(view2)
                 z0_target, z1_target = target_network(view1), target_network(view2)